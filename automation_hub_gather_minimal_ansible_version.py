@@ -11,21 +11,30 @@
 '''
 
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import logging
 import sys
 import os
 import yaml
 import re
 import openpyxl
+import orjson
 import errno
+import hashlib
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum
+from itertools import takewhile
 from datetime import datetime
 from datetime import timedelta
 from pathlib import Path
 from argparse import ArgumentParser
 from getpass import getpass
-from pprint import pformat, pprint
-from packaging.version import Version, parse
+from typing import Optional
+from pprint import pformat
 
 __author__ = 'Steffen Scheib'
 __copyright__ = 'Copyright 2025, Steffen Scheib'
@@ -40,6 +49,29 @@ LOG = logging.getLogger(os.path.basename(os.path.splitext(__file__)[0]))
 API_URL = 'https://console.redhat.com'
 API_USERNAME = ''
 API_PASSWORD = ''
+# maximum number of concurrent requests to the API
+API_MAX_WORKERS = 16
+# number of collections to request per page of the collection index
+API_PAGE_LIMIT = 500
+# fields of the highest version of a collection which are actually used
+HIGHEST_VERSION_FIELDS = ['requires_ansible', 'metadata']
+# whether the API accepts the fields parameter; set to False once the API rejects it (shared by all workers)
+HIGHEST_VERSION_FIELDS_SUPPORTED = True
+HIGHEST_VERSION_FIELDS_LOCK = threading.Lock()
+# the collection versions are cached on disk (in the user's cache directory) per API and user for the given number
+# of seconds; all other responses (e.g. the collection index, which contains the download counts) are not cached
+API_CACHE_NAME = 'automation_hub_gather_minimal_ansible_version'
+API_CACHE_EXPIRE_AFTER = 3600
+API_CACHE_URLS_EXPIRE_AFTER = {
+  '*/collections/index/*/versions/*': API_CACHE_EXPIRE_AFTER
+}
+# timeout in seconds for a single request to the API
+API_TIMEOUT = 60
+# strips the comparison operators and any further version constraints from 'requires_ansible' (e.g. '>=2.14.0,<2.18')
+REQUIRES_ANSIBLE_RE = re.compile(r'>=|<=|>|<|,.*')
+# extracts the major and the (optional) minor version from the stripped 'requires_ansible' (e.g. '2.15', 'v2.15rc1')
+ANSIBLE_VERSION_RE = re.compile(r'\s*v?(\d+)(?:\.(\d+))?')
+
 
 class HttpRequestType(Enum):
     '''Representation of the different HTTP request types'''
@@ -49,6 +81,42 @@ class HttpRequestType(Enum):
     DELETE = 4
 
 
+class ApiRetry(Retry):
+    '''Retry policy which backs off before the first retry already and caps the Retry-After header
+
+    The delay before the n-th retry is backoff_factor * 2^(n-1) seconds, multiplied by a random factor between 1 and
+    1 + backoff_jitter, and capped at backoff_max. A Retry-After header sent by the API is capped at backoff_max as
+    well.
+    '''
+
+    def get_backoff_time(self) -> float:
+        # consider only the last consecutive errors (ignore redirects)
+        consecutive_errors = len(list(takewhile(lambda x: x.redirect_location is None, reversed(self.history))))
+        if consecutive_errors == 0:
+            return 0
+
+        backoff = self.backoff_factor * (2 ** (consecutive_errors - 1))
+        return min(self.backoff_max, backoff * (1 + random.random() * self.backoff_jitter))
+
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+
+        return min(self.backoff_max, retry_after)
+
+
+# transient errors (connection errors, timeouts, 429 and 5xx) are retried up to 3 times, waiting about 1s, 2s and 4s
+# (plus up to 50% jitter, at most 30s) or as long as the Retry-After header demands (at most 30s)
+API_RETRY = ApiRetry(total=3,
+                     backoff_factor=1,
+                     backoff_max=30,
+                     backoff_jitter=0.5,
+                     status_forcelist=[429, 500, 502, 503, 504],
+                     respect_retry_after_header=True,
+                     raise_on_status=False)
+
+
 def query_api(http_request_type: HttpRequestType, location: str, data: str = None) -> dict:
   """Queries the API
   Queries the Automation Hub API and returns the result as JSON formatted string.
@@ -69,13 +137,11 @@ def query_api(http_request_type: HttpRequestType, location: str, data: str = Non
       TypeError: If the second argument is not an instance of ApiType
       TypeError: If the optional third argument is given, but is not a string
       ValueError: If the optional third argument is given, but is not a JSON formatted string
-      ValueError: If the given HTTP request type is not supported
       HTTPError: If the request returns with an unsuccessful status code
       ConnectionError: If a connection to the  API cannot be established (DNS failure, connection
                        refused, etc)
       Timeout: If the request exceeds the maximum time in which it didn't receive any data
       RequestException: If the HTTP request fails for another reason
-      RuntimeError: If the HTTP request fails for some reason
   """
   # check existence and type of the first argument
   if not http_request_type or http_request_type is None:
@@ -91,44 +157,21 @@ def query_api(http_request_type: HttpRequestType, location: str, data: str = Non
       raise TypeError(f'Given value for the second argument (\'location\') is not a string. Type of value '
                       f'is {type(location)}.')
 
-  if data is not None:
-    LOG.debug(f'Using HTTP {http_request_type.name} on {API_URL + location} payload {pformat(data)}')
-  else:
-    LOG.debug(f'Using HTTP {http_request_type.name} on {API_URL + location}')
+  if LOG.isEnabledFor(logging.DEBUG):
+    if data is not None:
+      LOG.debug(f'Using HTTP {http_request_type.name} on {API_URL + location} payload {pformat(data)}')
+    else:
+      LOG.debug(f'Using HTTP {http_request_type.name} on {API_URL + location}')
 
 
   # do the HTTP request
-  auth = (API_USERNAME, API_PASSWORD)
   try:
-      if http_request_type is HttpRequestType.GET:
-          response = requests.get(API_URL + location,
-                                  data=data,
-                                  auth=auth,
-                                  headers={'content-type': 'application/json'})
-      elif http_request_type is HttpRequestType.POST:
-          response = requests.post(API_URL + location,
-                                   data=data,
-                                   auth=auth,
-                                   headers={'content-type': 'application/json'})
-      elif http_request_type is HttpRequestType.PUT:
-          response = requests.put(API_URL + location,
-                                  data=data,
-                                  auth=auth,
-                                  headers={'content-type': 'application/json'})
-      elif http_request_type is HttpRequestType.DELETE:
-          response = requests.delete(API_URL + location,
-                                     data=data,
-                                     auth=auth,
-                                     headers={'content-type': 'application/json'})
-      else:
-          raise ValueError(f'Given HTTP request type is not supported! Given is {http_request_type.name}.')
-
-      return response.json()
+      response = SESSION.request(http_request_type.name, API_URL + location, data=data, timeout=API_TIMEOUT)
       response.raise_for_status()
   except requests.exceptions.HTTPError as http_error:
       raise requests.exceptions.HTTPError(f'The HTTP {http_request_type.name} request failed with an HTTPError. '
                                           f'Following the complete error:'
-                                          f' {http_error}')
+                                          f' {http_error}', response=http_error.response)
   except requests.exceptions.ConnectionError as connection_error:
       raise requests.exceptions.ConnectionError(f'Unable to connect to the configured API {API_URL}. '
                                                 f'Following the complete error: '
@@ -145,12 +188,94 @@ def query_api(http_request_type: HttpRequestType, location: str, data: str = Non
                                                  f'the complete error: '
                                                  f'{request_exception}')
 
-  if not response.ok:
-      raise RuntimeError(f'Last {http_request_type.name} request failed. Request returned with '
-                         f'HTTP code {response.status_code}')
-
   # return the response as JSON
-  return response.json()
+  return orjson.loads(response.content)
+
+
+def query_highest_version(href: str) -> dict:
+  """Queries the highest version of a collection
+  Queries only the fields given in HIGHEST_VERSION_FIELDS of the highest version of a collection, instead of the full
+  collection version (which includes e.g. the docs blob and the contents). Should the API reject the fields parameter
+  (HTTP 400), the full collection version is queried and the fields parameter is not used for any later query. Used as
+  worker when fetching multiple collection versions concurrently.
+
+  Args:
+      href (str): Location of the highest version of the collection
+
+  Returns:
+      dict: The highest version of the collection as JSON formatted string (=dict)
+  """
+  global HIGHEST_VERSION_FIELDS_SUPPORTED
+
+  if not HIGHEST_VERSION_FIELDS_SUPPORTED:
+      return query_api(HttpRequestType.GET, href)
+
+  separator = '&' if '?' in href else '?'
+  try:
+      return query_api(HttpRequestType.GET, f'{href}{separator}fields={",".join(HIGHEST_VERSION_FIELDS)}')
+  except requests.exceptions.HTTPError as http_error:
+      if http_error.response is None or http_error.response.status_code != 400:
+          raise
+
+      with HIGHEST_VERSION_FIELDS_LOCK:
+          if HIGHEST_VERSION_FIELDS_SUPPORTED:
+              LOG.debug('The fields parameter has been rejected by the API, querying without it from now on')
+              HIGHEST_VERSION_FIELDS_SUPPORTED = False
+
+      return query_api(HttpRequestType.GET, href)
+
+
+def query_first_page(href: str) -> dict:
+  """Queries the first page of a collection index
+  Queries the first page of the collection index with API_PAGE_LIMIT collections per page. Should the API reject the
+  page size (HTTP 400), the page size is halved until the API accepts it. The links to the following pages returned
+  by the API retain the accepted page size.
+
+  Args:
+      href (str): Location of the collection index (without query parameters)
+
+  Returns:
+      dict: The first page of the collection index as JSON formatted string (=dict)
+
+  Raises:
+      HTTPError: If the request returns with an unsuccessful status code other than HTTP 400, or the API rejects
+                 even a page size of 1
+  """
+  limit = API_PAGE_LIMIT
+  while True:
+      try:
+          return query_api(HttpRequestType.GET, f'{href}?limit={limit}')
+      except requests.exceptions.HTTPError as http_error:
+          if http_error.response is None or http_error.response.status_code != 400 or limit == 1:
+              raise
+
+          LOG.debug(f'Page size {limit} has been rejected by the API, retrying with page size {limit // 2}')
+          limit = limit // 2
+
+
+def crawl(href: str, executor: ThreadPoolExecutor) -> list:
+  """Crawls a repository
+  Walks through all pages of the collection index of a repository and fetches the highest version of each
+  collection concurrently using the given executor.
+
+  Args:
+      href (str): Location of the collection index of the repository (without query parameters)
+      executor (ThreadPoolExecutor): The executor to fetch the highest versions of the collections with
+
+  Returns:
+      list: Tuples of each collection and its highest version, in the order returned by the API
+  """
+  collections = list()
+  result = query_first_page(href)
+  while True:
+      hrefs_to_fetch = [collection['highest_version']['href'] for collection in result['data']]
+      collections.extend(zip(result['data'], executor.map(query_highest_version, hrefs_to_fetch)))
+
+      # we are done once no next link is given
+      if result['links']['next'] is None:
+          return collections
+
+      result = query_api(HttpRequestType.GET, result['links']['next'])
 
 parser = ArgumentParser()
 parser.add_argument('--api-url', dest='api_url',
@@ -174,6 +299,9 @@ parser.add_argument('--clear-workbook', action='store_true', dest='clear_workboo
 parser.add_argument('--ignore-authors', action='store_true', dest='ignore_authors', default=False,
                     help='Add authors of the collection to the workbook',
                     required=False)
+parser.add_argument('--no-cache', action='store_false', dest='use_cache', default=True,
+                    help='Do not cache the collection versions on disk',
+                    required=False)
 args = parser.parse_args()
 
 # set the log level
@@ -193,10 +321,29 @@ if args.api_password:
 else:
     API_PASSWORD = getpass(f'Password for user {API_USERNAME}: ')
 
+# a single session is used for all requests, so the connection to the API is kept alive and reused
+if args.use_cache:
+    # the cache is scoped per API and user, since the cache key does not include the credentials; cached responses are
+    # served even when expired should the API fail (stale_if_error)
+    cache_scope = hashlib.sha256(f'{API_URL} {API_USERNAME}'.encode()).hexdigest()[:16]
+    SESSION = requests_cache.CachedSession(f'{API_CACHE_NAME}_{cache_scope}',
+                                           use_cache_dir=True,
+                                           expire_after=requests_cache.DO_NOT_CACHE,
+                                           urls_expire_after=API_CACHE_URLS_EXPIRE_AFTER,
+                                           stale_if_error=True)
+else:
+    SESSION = requests.Session()
+
+SESSION_ADAPTER = HTTPAdapter(pool_connections=1, pool_maxsize=32, max_retries=API_RETRY)
+SESSION.mount('https://', SESSION_ADAPTER)
+SESSION.mount('http://', SESSION_ADAPTER)
+SESSION.auth = (API_USERNAME, API_PASSWORD)
+SESSION.headers.update({'content-type': 'application/json'})
+
 # set the initial href for each repository type
 hrefs = {
-  'validated': '/api/automation-hub/v3/plugin/ansible/content/validated/collections/index/?limit=100',
-  'certified': '/api/automation-hub/v3/plugin/ansible/content/published/collections/index/?limit=100'
+  'validated': '/api/automation-hub/v3/plugin/ansible/content/validated/collections/index/',
+  'certified': '/api/automation-hub/v3/plugin/ansible/content/published/collections/index/'
 }
 
 if args.write_workbook:
@@ -209,81 +356,81 @@ if args.write_workbook:
             if oserror_exception.errno != errno.ENOENT: # errno.ENOENT = no such file or directory
                 raise
 
-    workbook = openpyxl.Workbook()
+    # a write-only workbook streams the rows to disk and does not contain an initial sheet
+    workbook = openpyxl.Workbook(write_only=True)
     worksheet = workbook.create_sheet('Collections Ansible versions')
     # create the header column for the worksheet
-    worksheet.cell(column=1, row=1, value='Collection Name')
-    worksheet.cell(column=2, row=1, value='Repository')
-    worksheet.cell(column=3, row=1, value='Ansible Version')
-    worksheet.cell(column=4, row=1, value='Downloads')
+    header = ['Collection Name', 'Repository', 'Ansible Version', 'Downloads']
 
     if not args.ignore_authors:
-        worksheet.cell(column=5, row=1, value='Authors')
+        header.append('Authors')
+
+    worksheet.append(header)
 
 ansible_versions = dict()
 
-# initial row accomodates for the header column
-row = 2
-
-# iterate over all repositories
-for collection_repo, initial_href in hrefs.items():
-
-    href = initial_href
-    while True:
-        result = query_api(HttpRequestType.GET, href)
-
-        # iterate over each collection
-        for collection in result['data']:
-
-            collection_name = collection['name']
-            collection_namespace = collection['namespace']
-            collection_fqcn = f'{collection_namespace}.{collection_name}'
-            download_count = collection['download_count']
-            highest_version = query_api(HttpRequestType.GET, collection['highest_version']['href'])
-            ansible_version = Version(re.sub(',[0-9.]+', '', re.sub('>=|<=|>|<|,[0-9.]+', '', highest_version['requires_ansible'])))
-            authors = ', '.join(highest_version['metadata']['authors'])
-            ansible_minor_version = f'{ansible_version.major}.{ansible_version.minor}'
-
-            if ansible_minor_version in ansible_versions:
-                ansible_versions[ansible_minor_version]['collections'].append(
-                    {
-                        'name': collection_fqcn,
-                        'download_count': download_count
-                    }
-                )
-            else:
-                ansible_versions[ansible_minor_version] = {
-                    'collections': [
-                        {
-                            'name': collection_fqcn,
-                            'download_count': download_count
-                        }
-                    ]
-                }
-
-            if args.write_workbook:            
-                worksheet.cell(column=1, row=row, value=collection_fqcn)
-                worksheet.cell(column=2, row=row, value=collection_repo)
-                worksheet.cell(column=3, row=row, value=ansible_minor_version)
-                worksheet.cell(column=4, row=row, value=str(download_count))
-
-                if not args.ignore_authors:
-                    worksheet.cell(column=5, row=row, value=str(authors))
-
-            pprint(f"collection {collection_fqcn} (#{download_count} downloads): -> {str(ansible_minor_version)}")
-            row = row + 1
-
-        # we are done once no next link is given
-        if result['links']['next'] is None:
-            break
-
-        # assign new href
-        href = result['links']['next']
+# all repositories are crawled concurrently; the highest versions of the collections are fetched concurrently
+# using a shared executor, which limits the number of concurrent requests to the API. The results (and thus the
+# output per collection) are only available once all repositories have been crawled completely
+executor = ThreadPoolExecutor(max_workers=API_MAX_WORKERS)
+crawl_executor = ThreadPoolExecutor(max_workers=len(hrefs))
+try:
+    crawls = {crawl_executor.submit(crawl, initial_href, executor): collection_repo
+              for collection_repo, initial_href in hrefs.items()}
+    crawled = dict()
+    for future in as_completed(crawls):
+        crawled[crawls[future]] = future.result()
+except BaseException:
+    # fail right away: cancel all pending requests instead of waiting for the other crawls to finish
+    executor.shutdown(wait=False, cancel_futures=True)
+    crawl_executor.shutdown(wait=False, cancel_futures=True)
+    raise
+
+crawl_executor.shutdown()
+executor.shutdown()
+
+# keep the order of the repositories
+collections = {collection_repo: crawled[collection_repo] for collection_repo in hrefs}
+
+# the results are processed sequentially (openpyxl is not thread-safe)
+for collection_repo, repo_collections in collections.items():
+
+    # iterate over each collection
+    for collection, highest_version in repo_collections:
+
+        collection_name = collection['name']
+        collection_namespace = collection['namespace']
+        collection_fqcn = f'{collection_namespace}.{collection_name}'
+        download_count = collection['download_count']
+        requires_ansible = highest_version['requires_ansible'] or ''
+        ansible_version = ANSIBLE_VERSION_RE.match(REQUIRES_ANSIBLE_RE.sub('', requires_ansible))
+        if ansible_version is None:
+            LOG.warning('collection %s: unable to determine the Ansible version from requires_ansible %r, skipping',
+                        collection_fqcn, requires_ansible)
+            continue
+
+        authors = ', '.join(highest_version['metadata']['authors'])
+        # a missing minor version (e.g. '>=2') is treated as minor version 0
+        ansible_minor_version = f'{int(ansible_version.group(1))}.{int(ansible_version.group(2) or 0)}'
+
+        ansible_versions.setdefault(ansible_minor_version, {'collections': []})['collections'].append(
+            {
+                'name': collection_fqcn,
+                'download_count': download_count
+            }
+        )
+
+        if args.write_workbook:
+            worksheet_row = [collection_fqcn, collection_repo, ansible_minor_version, str(download_count)]
+
+            if not args.ignore_authors:
+                worksheet_row.append(str(authors))
+
+            worksheet.append(worksheet_row)
+
+        LOG.info('collection %s (#%d downloads): -> %s', collection_fqcn, download_count, ansible_minor_version)
 
 if args.write_workbook:
-    # delete the initially created sheet
-    workbook.remove(workbook['Sheet'])
-
     # save the workbook
     workbook.save(workbook_path)
 